@@ -24,7 +24,8 @@ if sys.version_info[0] < 3:  # pragma: no cover
     import ConfigParser as configparser
     from urlparse import urlparse, urlunparse, urljoin, urlsplit, urlunsplit
     from urllib import (urlretrieve, quote as _quote, unquote, url2pathname,
-                        pathname2url, ContentTooShortError, splittype)
+                        pathname2url, ContentTooShortError, splittype,
+                        getproxies, proxy_bypass)
 
     def quote(s):
         if isinstance(s, unicode):
@@ -74,7 +75,7 @@ else:  # pragma: no cover
                                 pathname2url,
                                 HTTPBasicAuthHandler, HTTPPasswordMgr,
                                 HTTPHandler, HTTPRedirectHandler,
-                                build_opener)
+                                build_opener, getproxies, proxy_bypass)
     if ssl:
         from urllib.request import HTTPSHandler
     from urllib.error import HTTPError, URLError, ContentTooShortError
@@ -625,6 +626,34 @@ except ImportError:  # pragma: no cover
             suffix = 'o'
         return path + suffix
 
+try:
+    from functools import lru_cache
+except ImportError:  # pragma: no cover
+    def lru_cache(maxsize=128):
+        """
+        A minimal stand-in for functools.lru_cache, for Python 2.7. Only
+        positional arguments are supported, and rather than evicting the least
+        recently used entry when full, the whole cache is cleared.
+        """
+        def decorator(func):
+            cache = {}
+
+            def wrapper(*args):
+                try:
+                    return cache[args]
+                except KeyError:
+                    pass
+                result = func(*args)
+                if len(cache) >= maxsize:
+                    cache.clear()
+                cache[args] = result
+                return result
+
+            wrapper.cache_clear = cache.clear
+            wrapper.__wrapped__ = func
+            return wrapper
+        return decorator
+
 try:
     from collections import OrderedDict
 except ImportError: # pragma: no cover
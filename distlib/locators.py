@@ -5,13 +5,14 @@
 # See LICENSE.txt and CONTRIBUTORS.txt.
 #
 
-import gzip
-from io import BytesIO
+import hashlib
 import json
 import logging
 import os
 import posixpath
 import re
+import socket
+import tempfile
 try:
     import threading
 except ImportError:  # pragma: no cover
@@ -22,12 +23,13 @@ from . import DistlibException
 from .compat import (urljoin, urlparse, urlunparse, url2pathname, pathname2url,
                      queue, quote, unescape, build_opener,
                      HTTPRedirectHandler as BaseRedirectHandler, text_type,
-                     Request, HTTPError, URLError)
+                     Request, HTTPError, URLError, httplib, ssl, getproxies,
+                     proxy_bypass, lru_cache, xmlrpclib)
 from .database import Distribution, DistributionPath, make_dist
 from .metadata import Metadata, MetadataInvalidError
 from .util import (cached_property, ensure_slash, split_filename, get_project_data,
                    parse_requirement, parse_name_and_version, ServerProxy,
-                   normalize_name)
+                   normalize_name, Cache, get_cache_base)
 from .version import get_scheme, UnsupportedVersionError
 from .wheel import Wheel, is_compatible
 
@@ -38,6 +40,97 @@ CHARSET = re.compile(r';\s*charset\s*=\s*(.*)\s*$', re.I)
 HTML_CONTENT_TYPE = re.compile('text/html|application/x(ht)?ml')
 DEFAULT_INDEX = 'https://pypi.org/pypi'
 
+# The same links and filenames are parsed repeatedly while scraping (each link
+# is looked at by several methods, and the same archives are often listed on
+# several pages), so the results of parsing them are cached.
+_urlparse = lru_cache(maxsize=4096)(urlparse)
+_split_filename = lru_cache(maxsize=4096)(split_filename)
+
+# The following slightly hairy-looking regex just looks for the contents of
+# an anchor link, which has an attribute "href" either immediately preceded
+# or immediately followed by a "rel" attribute. The attribute values can be
+# declared with double quotes, single quotes or no quotes - which leads to
+# the length of the expression. The leading lookahead doesn't change what is
+# matched, but tells the regex engine which characters a match can start with,
+# so it can skip quickly over the rest of the page.
+HREF = re.compile("""
+(?=[rh])(rel\\s*=\\s*(?:"(?P<rel1>[^"]*)"|'(?P<rel2>[^']*)'|(?P<rel3>[^>\\s\n]*))\\s+)?
+href\\s*=\\s*(?:"(?P<url1>[^"]*)"|'(?P<url2>[^']*)'|(?P<url3>[^>\\s\n]*))
+(\\s+rel\\s*=\\s*(?:"(?P<rel4>[^"]*)"|'(?P<rel5>[^']*)'|(?P<rel6>[^>\\s\n]*)))?
+""", re.I | re.S | re.X)
+BASE_HREF = re.compile(r"""<base\s+href\s*=\s*['"]?([^'">]+)""", re.I | re.S)
+
+_URL_PREFIX = re.compile(r'[a-z][a-z0-9+.-]*://[^/?#]*', re.I)
+
+def _url_key(url):
+    """
+    Return the key used to tell whether an URL has already been seen while
+    scraping. This ignores any fragment (such as a digest) and the case of the
+    scheme and host name, so that such variants of an URL aren't processed
+    repeatedly. It's computed from the URL text, without parsing it.
+    """
+    url = url.partition('#')[0]
+    m = _URL_PREFIX.match(url)
+    if m:
+        url = m.group().lower() + url[m.end():]
+    return url
+
+# Relative path references without scheme, params or whitespace, such as the
+# "../../packages/..." links on PyPI's simple pages.
+_RELATIVE_PATH = re.compile(r'[^/?#:;\x00-\x20][^:;\x00-\x20]*\Z')
+
+def _link_resolver(base):
+    """
+    Return a function which resolves links against the specified base URL,
+    as urljoin() does. The base is parsed only once, and simple relative path
+    references are resolved directly against it rather than being parsed and
+    unparsed for each link. Where urljoin() behaves differently across Python
+    versions (empty segments, or more '..' segments than the base path has
+    directories) links are always passed to urljoin().
+    """
+    scheme, netloc, bpath = urlparse(base)[:3]
+    base_parts = bpath.split('/')[:-1]
+    if (scheme not in ('http', 'https', 'file') or bpath[:1] != '/' or
+        '' in base_parts[1:] or '.' in base_parts or '..' in base_parts):
+        return lambda url: urljoin(base, url)
+    prefix = '%s://%s' % (scheme, netloc)
+
+    def resolve(url):
+        if not _RELATIVE_PATH.match(url):
+            return urljoin(base, url)
+        path, _, fragment = url.partition('#')
+        path, _, query = path.partition('?')
+        segments = path.split('/')
+        if '' in segments[:-1] or segments[-1] in ('.', '..'):
+            return urljoin(base, url)
+        resolved = list(base_parts)
+        for seg in segments:
+            if seg == '..':
+                if len(resolved) == 1:  # would go above the root
+                    return urljoin(base, url)
+                resolved.pop()
+            elif seg != '.':
+                resolved.append(seg)
+        result = prefix + '/'.join(resolved)
+        if query:
+            result += '?' + query
+        if fragment:
+            result += '#' + fragment
+        return result
+
+    return resolve
+
+@lru_cache(maxsize=16)
+def _extension_re(extensions):
+    """
+    Return a compiled regex which matches any of the specified archive
+    extensions (or a wheel extension) at the end of a path, so that a single
+    search both checks that a path is downloadable and finds its extension.
+    Longer extensions are tried first, so that e.g. '.tar.gz' wins over '.gz'.
+    """
+    extensions = sorted(set(extensions + ('.whl',)), key=len, reverse=True)
+    return re.compile('(?:%s)\\Z' % '|'.join(re.escape(e) for e in extensions))
+
 def get_all_distribution_names(url=None):
     """
     Return all distribution names known by an index.
@@ -99,6 +192,15 @@ class Locator(object):
 
     downloadable_extensions = source_extensions + ('.whl',)
 
+    # These are used to deal with various Content-Encoding schemes. For gzip,
+    # zlib is asked to expect a gzip header and trailer (16 + MAX_WBITS), which
+    # avoids the overhead of going through a GzipFile.
+    decoders = {
+        'deflate': zlib.decompress,
+        'gzip': lambda b: zlib.decompress(b, 16 + zlib.MAX_WBITS),
+        'none': lambda b: b,
+    }
+
     def __init__(self, scheme='default'):
         """
         Initialise an instance.
@@ -108,6 +210,9 @@ class Locator(object):
                        if you need to support existing distributions on PyPI.
         """
         self._cache = {}
+        # Parsed versions, keyed by (version class, version string), so that
+        # locate() doesn't parse the same versions every time it's called.
+        self._parsed_versions = {}
         self.scheme = scheme
         # Because of bugs in some of the handlers on some of the platforms,
         # we use our own opener rather than just using urlopen.
@@ -141,6 +246,7 @@ class Locator(object):
 
     def clear_cache(self):
         self._cache.clear()
+        self._parsed_versions.clear()
 
     def _get_scheme(self):
         return self._scheme
@@ -190,7 +296,7 @@ class Locator(object):
         Give an url a score which can be used to choose preferred URLs
         for a given project release.
         """
-        t = urlparse(url)
+        t = _urlparse(url)
         basename = posixpath.basename(t.path)
         compatible = True
         is_wheel = basename.endswith('.whl')
@@ -226,7 +332,7 @@ class Locator(object):
         """
         Attempt to split a filename in project name, version and Python version.
         """
-        return split_filename(filename, project_name)
+        return _split_filename(filename, project_name)
 
     def convert_url_to_download_info(self, url, project_name):
         """
@@ -239,8 +345,19 @@ class Locator(object):
         def same_project(name1, name2):
             return normalize_name(name1) == normalize_name(name2)
 
+        # Most links which aren't downloads can be rejected from the URL text
+        # alone, without parsing it. Params (after a ';') would end up off the
+        # path, so URLs with them are always parsed.
+        extension_re = _extension_re(self.downloadable_extensions)
+        stem = url.split('#', 1)[0].split('?', 1)[0]
+        if stem[-1:] == '/':
+            stem = stem[:-1]
+        if ';' not in stem and not extension_re.search(stem):
+            logger.debug('Not downloadable: %s', url)
+            return None
         result = None
-        scheme, netloc, path, params, query, frag = urlparse(url)
+        path = _urlparse(url).path
+        url, _, frag = url.partition('#')
         if frag.lower().startswith('egg='):  # pragma: no cover
             logger.debug('%s: version hint in fragment: %r',
                          project_name, frag)
@@ -249,10 +366,11 @@ class Locator(object):
             algo, digest = m.groups()
         else:
             algo, digest = None, None
-        origpath = path
         if path and path[-1] == '/':  # pragma: no cover
             path = path[:-1]
-        if path.endswith('.whl'):
+        m = extension_re.search(path)
+        ext = m.group() if m else None
+        if ext == '.whl':
             try:
                 wheel = Wheel(path)
                 if not is_compatible(wheel, self.wheel_tags):
@@ -267,37 +385,32 @@ class Locator(object):
                             'name': wheel.name,
                             'version': wheel.version,
                             'filename': wheel.filename,
-                            'url': urlunparse((scheme, netloc, origpath,
-                                               params, query, '')),
+                            'url': url,
                             'python-version': ', '.join(
                                 ['.'.join(list(v[2:])) for v in wheel.pyver]),
                         }
             except Exception as e:  # pragma: no cover
                 logger.warning('invalid path for wheel: %s', path)
-        elif not path.endswith(self.downloadable_extensions):  # pragma: no cover
+        elif not ext:  # pragma: no cover
             logger.debug('Not downloadable: %s', path)
         else:  # downloadable extension
-            path = filename = posixpath.basename(path)
-            for ext in self.downloadable_extensions:
-                if path.endswith(ext):
-                    path = path[:-len(ext)]
-                    t = self.split_filename(path, project_name)
-                    if not t:  # pragma: no cover
-                        logger.debug('No match for project/version: %s', path)
-                    else:
-                        name, version, pyver = t
-                        if not project_name or same_project(project_name, name):
-                            result = {
-                                'name': name,
-                                'version': version,
-                                'filename': filename,
-                                'url': urlunparse((scheme, netloc, origpath,
-                                                   params, query, '')),
-                                #'packagetype': 'sdist',
-                            }
-                            if pyver:  # pragma: no cover
-                                result['python-version'] = pyver
-                    break
+            filename = posixpath.basename(path)
+            path = filename[:-len(ext)]
+            t = self.split_filename(path, project_name)
+            if not t:  # pragma: no cover
+                logger.debug('No match for project/version: %s', path)
+            else:
+                name, version, pyver = t
+                if not project_name or same_project(project_name, name):
+                    result = {
+                        'name': name,
+                        'version': version,
+                        'filename': filename,
+                        'url': url,
+                        #'packagetype': 'sdist',
+                    }
+                    if pyver:  # pragma: no cover
+                        result['python-version'] = pyver
         if result and algo:
             result['%s_digest' % algo] = digest
         return result
@@ -370,30 +483,48 @@ class Locator(object):
         logger.debug('matcher: %s (%s)', matcher, type(matcher).__name__)
         versions = self.get_project(r.name)
         if len(versions) > 2:   # urls and digests keys are present
-            # sometimes, versions are invalid
+            # Each version string is parsed just once (and remembered for later
+            # calls), and the parsed versions are used both for sorting and for
+            # matching. Working down from the most recent version, the first
+            # one which matches is the result, so most versions never need to
+            # be matched at all.
             slist = []
             vcls = matcher.version_class
+            parsed = self._parsed_versions
             for k in versions:
                 if k in ('urls', 'digests'):
                     continue
+                key = (vcls, k)
+                try:
+                    v = parsed[key]
+                except KeyError:
+                    try:
+                        v = vcls(k)
+                    except Exception:  # pragma: no cover
+                        # sometimes, versions are invalid
+                        v = None
+                    parsed[key] = v
+                if v is None:
+                    logger.warning('error matching %s with %r', matcher, k)
+                else:
+                    slist.append((v, k))
+            # If several versions are equal (e.g. 1.0 and 1.0.0), any one of
+            # them may be chosen
+            slist.sort(key=lambda t: t[0])
+            logger.debug('sorted list: %s', slist)
+            for v, k in reversed(slist):
                 try:
-                    if not matcher.match(k):
+                    if not matcher.match(v):
                         pass  # logger.debug('%s did not match %r', matcher, k)
-                    else:
-                        if prereleases or not vcls(k).is_prerelease:
-                            slist.append(k)
-                        # else:
-                            # logger.debug('skipping pre-release '
-                                         # 'version %s of %s', k, matcher.name)
+                    elif prereleases or not v.is_prerelease:
+                        version = k
+                        result = versions[version]
+                        break
+                    # else:
+                        # logger.debug('skipping pre-release '
+                                     # 'version %s of %s', k, matcher.name)
                 except Exception:  # pragma: no cover
                     logger.warning('error matching %s with %r', matcher, k)
-                    pass # slist.append(k)
-            if len(slist) > 1:
-                slist = sorted(slist, key=scheme.key)
-            if slist:
-                logger.debug('sorted list: %s', slist)
-                version = slist[-1]
-                result = versions[version]
         if result:
             if r.extras:
                 result.extras = r.extras
@@ -413,6 +544,9 @@ class PyPIRPCLocator(Locator):
     This locator uses XML-RPC to locate distributions. It therefore
     cannot be used with simple mirrors (that only mirror file content).
     """
+    # The maximum number of versions to ask about in one multicall
+    multicall_versions = 50
+
     def __init__(self, url, **kwargs):
         """
         Initialise an instance.
@@ -423,6 +557,9 @@ class PyPIRPCLocator(Locator):
         super(PyPIRPCLocator, self).__init__(**kwargs)
         self.base_url = url
         self.client = ServerProxy(url, timeout=3.0)
+        # Set to False if the server turns out not to support multicall
+        self.use_multicall = True
+        self._multicall_works = False   # set once a multicall has succeeded
 
     def get_distribution_names(self):
         """
@@ -430,12 +567,52 @@ class PyPIRPCLocator(Locator):
         """
         return set(self.client.list_packages())
 
-    def _get_project(self, name):
-        result = {'urls': {}, 'digests': {}}
-        versions = self.client.package_releases(name, True)
+    def _get_releases(self, name, versions):
+        """
+        Get the URLs and release data for the specified versions of a project,
+        yielding a (version, urls, data) tuple for each version. If the server
+        supports it, the requests are batched using system.multicall, which
+        saves two round trips per version; otherwise, they're made one by
+        one.
+        """
+        versions = list(versions)
+        if self.use_multicall:
+            results = []
+            n = self.multicall_versions
+            for i in range(0, len(versions), n):
+                batch = versions[i:i + n]
+                multicall = xmlrpclib.MultiCall(self.client)
+                for v in batch:
+                    multicall.release_urls(name, v)
+                    multicall.release_data(name, v)
+                try:
+                    it = iter(multicall())
+                except xmlrpclib.Fault as e:
+                    # Only a fault on the first multicall is taken to mean
+                    # that the server doesn't support it. Faults for the
+                    # individual calls in a batch are raised by next(it)
+                    # below, and propagate as they would without multicall.
+                    if self._multicall_works:
+                        raise
+                    logger.debug('Multicall failed, not using it: %s', e)
+                    self.use_multicall = False
+                    break
+                self._multicall_works = True
+                for v in batch:
+                    results.append((v, next(it), next(it)))
+            if self.use_multicall:
+                for t in results:
+                    yield t
+                return
         for v in versions:
             urls = self.client.release_urls(name, v)
             data = self.client.release_data(name, v)
+            yield v, urls, data
+
+    def _get_project(self, name):
+        result = {'urls': {}, 'digests': {}}
+        versions = self.client.package_releases(name, True)
+        for v, urls, data in self._get_releases(name, versions):
             metadata = Metadata(scheme=self.scheme)
             metadata.name = data['name']
             metadata.version = data['version']
@@ -475,8 +652,15 @@ class PyPIJSONLocator(Locator):
         result = {'urls': {}, 'digests': {}}
         url = urljoin(self.base_url, '%s/json' % quote(name))
         try:
-            resp = self.opener.open(url)
-            data = resp.read().decode() # for now
+            # The JSON compresses well, so ask for it gzipped. It's passed to
+            # json.loads() as bytes, which saves decoding it to a separate
+            # Unicode copy of the whole response first.
+            req = Request(url, headers={'Accept-Encoding': 'gzip'})
+            resp = self.opener.open(req)
+            data = resp.read()
+            encoding = resp.info().get('Content-Encoding')
+            if encoding:
+                data = self.decoders[encoding](data)   # fail if not found
             d = json.loads(data)
             md = Metadata(scheme=self.scheme)
             data = d['info']
@@ -529,18 +713,6 @@ class Page(object):
     """
     This class represents a scraped HTML page.
     """
-    # The following slightly hairy-looking regex just looks for the contents of
-    # an anchor link, which has an attribute "href" either immediately preceded
-    # or immediately followed by a "rel" attribute. The attribute values can be
-    # declared with double quotes, single quotes or no quotes - which leads to
-    # the length of the expression.
-    _href = re.compile("""
-(rel\\s*=\\s*(?:"(?P<rel1>[^"]*)"|'(?P<rel2>[^']*)'|(?P<rel3>[^>\\s\n]*))\\s+)?
-href\\s*=\\s*(?:"(?P<url1>[^"]*)"|'(?P<url2>[^']*)'|(?P<url3>[^>\\s\n]*))
-(\\s+rel\\s*=\\s*(?:"(?P<rel4>[^"]*)"|'(?P<rel5>[^']*)'|(?P<rel6>[^>\\s\n]*)))?
-""", re.I | re.S | re.X)
-    _base = re.compile(r"""<base\s+href\s*=\s*['"]?([^'">]+)""", re.I | re.S)
-
     def __init__(self, data, url):
         """
         Initialise an instance with the Unicode page contents and the URL they
@@ -548,7 +720,7 @@ href\\s*=\\s*(?:"(?P<url1>[^"]*)"|'(?P<url2>[^']*)'|(?P<url3>[^>\\s\n]*))
         """
         self.data = data
         self.base_url = self.url = url
-        m = self._base.search(self.data)
+        m = BASE_HREF.search(self.data)
         if m:
             self.base_url = m.group(1)
 
@@ -561,20 +733,16 @@ href\\s*=\\s*(?:"(?P<url1>[^"]*)"|'(?P<url2>[^']*)'|(?P<url3>[^>\\s\n]*))
         about their "rel" attribute, for determining which ones to treat as
         downloads and which ones to queue for further scraping.
         """
-        def clean(url):
-            "Tidy up an URL."
-            scheme, netloc, path, params, query, frag = urlparse(url)
-            return urlunparse((scheme, netloc, quote(path),
-                               params, query, frag))
-
+        resolve = _link_resolver(self.base_url)
         result = set()
-        for match in self._href.finditer(self.data):
+        for match in HREF.finditer(self.data):
             d = match.groupdict('')
             rel = (d['rel1'] or d['rel2'] or d['rel3'] or
                    d['rel4'] or d['rel5'] or d['rel6'])
             url = d['url1'] or d['url2'] or d['url3']
-            url = urljoin(self.base_url, url)
-            url = unescape(url)
+            url = resolve(url)
+            if '&' in url:
+                url = unescape(url)
             url = self._clean_re.sub(lambda m: '%%%2x' % ord(m.group(0)), url)
             result.add((url, rel))
         # We sort the result, hoping to bring the most recent versions
@@ -583,6 +751,110 @@ href\\s*=\\s*(?:"(?P<url1>[^"]*)"|'(?P<url2>[^']*)'|(?P<url3>[^>\\s\n]*))
         return result
 
 
+class PooledResponse(object):
+    """
+    This class wraps a response read over a pooled, persistent connection. It
+    provides the subset of the interface of responses returned by the opener
+    that get_page() relies on, and hands the connection back to the pool when
+    closed (provided the response has been read in full).
+    """
+    def __init__(self, locator, key, conn, response, url):
+        self.locator = locator
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        # Python 2's HTTPResponse has no readinto(), and _read() falls back to
+        # read() when there isn't one.
+        readinto = getattr(response, 'readinto', None)
+        if readinto is not None:
+            self.readinto = readinto
+
+    def info(self):
+        return self.response.msg
+
+    def geturl(self):
+        return self.url
+
+    def read(self, *args):
+        return self.response.read(*args)
+
+    def close(self):
+        conn = self.conn
+        if conn is not None:
+            self.conn = None
+            if self.response.isclosed():    # all of the body has been read
+                self.locator._release_connection(self.key, conn)
+            else:
+                conn.close()
+
+
+class PageCache(Cache):
+    """
+    A cache of scraped pages in the file system, which outlives the locator
+    which uses it. Pages are stored together with their ETag and Last-Modified
+    headers, so that they can be revalidated with conditional requests rather
+    than being downloaded again.
+    """
+    def __init__(self, base=None):
+        """
+        Initialise an instance.
+
+        :param base: The base directory where the cache should be located. If
+                     not specified, this will be the ``http-cache``
+                     directory under whatever :func:`get_cache_base` returns.
+        """
+        if base is None:
+            base = os.path.join(get_cache_base(), str('http-cache'))
+        super(PageCache, self).__init__(base)
+
+    def _path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.base, digest + '.json')
+
+    def get(self, url):
+        """
+        Return the entry cached for an URL, or ``None`` if there isn't one.
+        An entry is a dictionary with ``data`` (the page text), ``url`` (the
+        URL the page was fetched from after any redirects), ``etag`` and
+        ``last_modified`` keys.
+        """
+        try:
+            with open(self._path(url), 'rb') as f:
+                result = json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError, ValueError):
+            result = None
+        else:
+            # ignore truncated or foreign entries
+            if (not isinstance(result, dict) or result.get('key') != url or
+                not isinstance(result.get('data'), text_type) or
+                not isinstance(result.get('url'), text_type)):
+                result = None
+        return result
+
+    def put(self, url, data, final_url, etag=None, last_modified=None):
+        """
+        Cache a page fetched from an URL, replacing any existing entry.
+        """
+        entry = {
+            'key': url,
+            'data': data,
+            'url': final_url,
+            'etag': etag,
+            'last_modified': last_modified,
+        }
+        path = self._path(url)
+        try:
+            fd, fn = tempfile.mkstemp(dir=self.base, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(json.dumps(entry).encode('utf-8'))
+            if os.name == 'nt' and os.path.exists(path):  # pragma: no cover
+                os.remove(path)
+            os.rename(fn, path)
+        except (IOError, OSError) as e:  # pragma: no cover
+            logger.warning('Unable to cache %s: %s', url, e)
+
+
 class SimpleScrapingLocator(Locator):
     """
     A locator which scrapes HTML pages to locate downloads for a distribution.
@@ -590,29 +862,30 @@ class SimpleScrapingLocator(Locator):
     as pip's PackageFinder, which works in an analogous fashion.
     """
 
-    # These are used to deal with various Content-Encoding schemes.
-    decoders = {
-        'deflate': zlib.decompress,
-        'gzip': lambda b: gzip.GzipFile(fileobj=BytesIO(b)).read(),
-        'none': lambda b: b,
-    }
-
-    def __init__(self, url, timeout=None, num_workers=10, **kwargs):
+    def __init__(self, url, timeout=None, num_workers=10, page_cache=None,
+                 **kwargs):
         """
         Initialise an instance.
         :param url: The root URL to use for scraping.
         :param timeout: The timeout, in seconds, to be applied to requests.
                         This defaults to ``None`` (no timeout specified).
-        :param num_workers: The number of worker threads you want to do I/O,
-                            This defaults to 10.
+        :param num_workers: The maximum number of worker threads you want to do
+                            I/O. This defaults to 10.
+        :param page_cache: An optional :class:`PageCache` in which to keep
+                           fetched pages between runs. Cached pages are
+                           revalidated with conditional requests.
         :param kwargs: Passed to the superclass.
         """
         super(SimpleScrapingLocator, self).__init__(**kwargs)
         self.base_url = ensure_slash(url)
         self.timeout = timeout
+        self.page_cache = page_cache
         self._page_cache = {}
         self._seen = set()
-        self._to_fetch = queue.Queue()
+        self._seen_lock = threading.Lock()
+        # The queue of URLs to fetch is bounded, so that crawling big pages
+        # doesn't queue up an unlimited number of URLs (see _fetch).
+        self._to_fetch = queue.Queue(maxsize=num_workers * 16)
         self._bad_hosts = set()
         self.skip_externals = False
         self.num_workers = num_workers
@@ -623,19 +896,159 @@ class SimpleScrapingLocator(Locator):
         # in _prepare_threads.
         self._gplock = threading.RLock()
         self.platform_check = False  # See issue #112
+        # Idle persistent HTTP(S) connections, keyed by (scheme, netloc). They
+        # are shared between the worker threads while get_project runs, so
+        # that connection setup (TCP and TLS handshakes) is done once per host
+        # rather than once per page, and are closed when it's done.
+        self._connections = {}
+        self._pooling = False
+        self._proxies = getproxies()
+
+    def _get_connection(self, key):
+        """
+        Get a connection to the host identified by key, which is a tuple of
+        (scheme, netloc). An idle pooled connection is used if there is one,
+        otherwise a new connection is made. Returns a tuple of the connection
+        and a flag indicating whether it was taken from the pool.
+        """
+        with self._lock:
+            idle = self._connections.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, netloc = key
+        if scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+        return cls(netloc, timeout=self.timeout), False
+
+    def _release_connection(self, key, conn):
+        """
+        Return a connection to the pool, once a response on it has been read
+        in full. At most num_workers idle connections are kept per host, and
+        none outside of get_project (the connection is just closed).
+        """
+        with self._lock:
+            if self._pooling:
+                idle = self._connections.setdefault(key, [])
+                if len(idle) < self.num_workers:
+                    idle.append(conn)
+                    conn = None
+        if conn is not None:
+            conn.close()
+
+    def close_connections(self):
+        """
+        Close any idle persistent connections held by this locator. This is
+        done automatically when get_project finishes.
+        """
+        with self._lock:
+            conns = [c for idle in self._connections.values() for c in idle]
+            self._connections.clear()
+        for conn in conns:
+            conn.close()
+
+    def _can_pool(self, scheme, netloc):
+        """
+        Can an URL with the specified scheme and netloc be fetched over a
+        pooled connection? Anything which needs the opener's handlers (other
+        schemes, credentials, proxies) can't be.
+        """
+        if scheme == 'https':
+            result = ssl is not None
+        else:
+            result = scheme == 'http'
+        if result and (not netloc or '@' in netloc):
+            result = False
+        if result and scheme in self._proxies:
+            result = proxy_bypass(netloc.split(':', 1)[0])
+        return result
+
+    def _request(self, key, selector, headers):
+        """
+        Send a GET request for selector to the host identified by key, and
+        return the response and the connection it was read from.
+        """
+        conn, reused = self._get_connection(key)
+        try:
+            conn.request('GET', selector, headers=headers)
+            resp = conn.getresponse()
+        except (socket.error, httplib.HTTPException) as e:
+            conn.close()
+            if reused:
+                # The server has probably closed the idle connection, so
+                # try again on another one.
+                return self._request(key, selector, headers)
+            if isinstance(e, socket.error):
+                raise URLError(e)
+            raise
+        return resp, conn
+
+    def _open(self, url, headers):
+        """
+        Open an URL for reading, following any redirects. HTTP(S) URLs are
+        fetched over pooled persistent connections; others are passed to the
+        opener. Raises HTTPError for responses other than 2xx ones (including
+        304 Not Modified), as the opener does.
+        """
+        headers = dict(self.opener.addheaders, **headers)
+        redirects = 0
+        while True:
+            scheme, netloc, path, params, query, _ = urlparse(url)
+            if not self._can_pool(scheme, netloc):
+                req = Request(url, headers=headers)
+                return self.opener.open(req, timeout=self.timeout)
+            key = (scheme, netloc)
+            selector = urlunparse(('', '', path or '/', params, query, ''))
+            resp, conn = self._request(key, selector, headers)
+            status = resp.status
+            newurl = None
+            if status in (301, 302, 303, 307, 308):
+                newurl = resp.getheader('Location') or resp.getheader('URI')
+            if newurl is None and 200 <= status < 300:
+                return PooledResponse(self, key, conn, resp, url)
+            hdrs = resp.msg
+            resp.read()
+            self._release_connection(key, conn)
+            if newurl is None:
+                raise HTTPError(url, status, resp.reason, hdrs, None)
+            redirects += 1
+            if redirects > RedirectHandler.max_redirections:
+                raise HTTPError(url, status, 'Too many redirects', hdrs, None)
+            # As with the opener, only redirects to http, https and ftp URLs
+            # are allowed - not, for example, to file: URLs.
+            newurl = urljoin(url, newurl)
+            if urlparse(newurl)[0] not in ('http', 'https', 'ftp'):
+                msg = "%s - Redirection to url '%s' is not allowed" % (
+                      resp.reason, newurl)
+                raise HTTPError(newurl, status, msg, hdrs, None)
+            url = newurl
 
     def _prepare_threads(self):
         """
         Threads are created only when get_project is called, and terminate
         before it returns. They are there primarily to parallelise I/O (i.e.
         fetching web pages).
+
+        Rather than starting num_workers threads up front, a thread is started
+        for each URL queued, up to that limit (see _queue_url). Most projects
+        need only one page to be fetched, and so only one thread.
         """
         self._threads = []
-        for i in range(self.num_workers):
-            t = threading.Thread(target=self._fetch)
-            t.daemon = True
-            t.start()
-            self._threads.append(t)
+
+    def _queue_url(self, url, block=True):
+        """
+        Queue an URL for fetching, starting another worker thread to fetch it
+        if the limit on worker threads hasn't been reached. If block is false
+        and the queue is full, queue.Full is raised.
+        """
+        self._to_fetch.put(url, block)
+        with self._lock:
+            if len(self._threads) < self.num_workers:
+                t = threading.Thread(target=self._fetch)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
 
     def _wait_threads(self):
         """
@@ -659,12 +1072,15 @@ class SimpleScrapingLocator(Locator):
             self._seen.clear()
             self._page_cache.clear()
             self._prepare_threads()
+            self._pooling = True
             try:
                 logger.debug('Queueing %s', url)
-                self._to_fetch.put(url)
+                self._queue_url(url)
                 self._to_fetch.join()
             finally:
                 self._wait_threads()
+                self._pooling = False
+                self.close_connections()
             del self.result
         return result
 
@@ -702,26 +1118,30 @@ class SimpleScrapingLocator(Locator):
         Determine whether a link URL from a referring page and with a
         particular "rel" attribute should be queued for scraping.
         """
-        scheme, netloc, path, _, _, _ = urlparse(link)
-        if path.endswith(self.source_extensions + self.binary_extensions +
-                         self.excluded_extensions):
-            result = False
-        elif self.skip_externals and not link.startswith(self.base_url):
+        # The cheap string tests come first, as they settle the question for
+        # most links (e.g. PyPI's simple pages have no "rel" attributes) and
+        # so spare the link from being parsed.
+        if rel not in ('homepage', 'download'):
             result = False
         elif not referrer.startswith(self.base_url):
             result = False
-        elif rel not in ('homepage', 'download'):
-            result = False
-        elif scheme not in ('http', 'https', 'ftp'):
-            result = False
-        elif self._is_platform_dependent(link):
+        elif self.skip_externals and not link.startswith(self.base_url):
             result = False
         else:
-            host = netloc.split(':', 1)[0]
-            if host.lower() == 'localhost':
+            scheme, netloc, path, _, _, _ = _urlparse(link)
+            if path.endswith(self.source_extensions + self.binary_extensions +
+                             self.excluded_extensions):
+                result = False
+            elif scheme not in ('http', 'https', 'ftp'):
+                result = False
+            elif self._is_platform_dependent(link):
                 result = False
             else:
-                result = True
+                host = netloc.split(':', 1)[0]
+                if host.lower() == 'localhost':
+                    result = False
+                else:
+                    result = True
         logger.debug('should_queue: %s (%s) from %s -> %s', link, rel,
                      referrer, result)
         return result
@@ -734,31 +1154,74 @@ class SimpleScrapingLocator(Locator):
         This is a handy method to run in a thread.
         """
         while True:
-            url = self._to_fetch.get()
+            item = self._to_fetch.get()
+            # Links found when the queue is full are fetched by this thread,
+            # rather than by waiting for space in the queue - which could
+            # deadlock, with every thread waiting. They're fetched before the
+            # task is marked as done, so that joining the queue still waits
+            # for them.
+            urls = [item] if item else []
             try:
-                if url:
-                    page = self.get_page(url)
-                    if page is None:    # e.g. after an error
-                        continue
-                    for link, rel in page.links:
-                        if link not in self._seen:
-                            try:
-                                self._seen.add(link)
-                                if (not self._process_download(link) and
-                                    self._should_queue(link, url, rel)):
-                                    logger.debug('Queueing %s from %s', link, url)
-                                    self._to_fetch.put(link)
-                            except MetadataInvalidError:  # e.g. invalid versions
-                                pass
-            except Exception as e:  # pragma: no cover
-                self.errors.put(text_type(e))
+                while urls:
+                    url = urls.pop()
+                    try:
+                        page = self.get_page(url)
+                        if page is None:    # e.g. after an error
+                            continue
+                        for link, rel in page.links:
+                            key = _url_key(link)
+                            with self._seen_lock:
+                                seen = key in self._seen
+                                if not seen:
+                                    self._seen.add(key)
+                            if not seen:
+                                try:
+                                    if (not self._process_download(link) and
+                                        self._should_queue(link, url, rel)):
+                                        logger.debug('Queueing %s from %s',
+                                                     link, url)
+                                        try:
+                                            self._queue_url(link, False)
+                                        except queue.Full:
+                                            urls.append(link)
+                                except MetadataInvalidError:  # e.g. invalid versions
+                                    pass
+                    except Exception as e:  # pragma: no cover
+                        self.errors.put(text_type(e))
             finally:
                 # always do this, to avoid hangs :-)
                 self._to_fetch.task_done()
-            if not url:
+            if not item:
                 #logger.debug('Sentinel seen, quitting.')
                 break
 
+    def _read(self, resp, headers):
+        """
+        Read the body of a response. If its length is known (and the response
+        supports it), the body is read straight into a buffer of that size,
+        rather than into intermediate chunks which then have to be joined.
+        The result is a bytes-like object.
+        """
+        readinto = getattr(resp, 'readinto', None)
+        try:
+            length = int(headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            length = -1
+        if readinto is None or length < 0:
+            result = resp.read()
+        else:
+            result = bytearray(length)
+            view = memoryview(result)
+            pos = 0
+            while pos < length:
+                n = readinto(view[pos:])
+                if not n:   # premature end of data
+                    break
+                pos += n
+            if pos < length:
+                result = result[:pos]
+        return result
+
     def get_page(self, url):
         """
         Get the HTML for an URL, possibly from an in-memory cache.
@@ -781,16 +1244,32 @@ class SimpleScrapingLocator(Locator):
             if host in self._bad_hosts:
                 logger.debug('Skipping %s due to bad host %s', url, host)
             else:
-                req = Request(url, headers={'Accept-encoding': 'identity'})
+                resp = None
+                req_headers = {'Accept-encoding': 'identity'}
+                cached = None
+                # Only remote pages are worth keeping on disk
+                if scheme in ('http', 'https'):
+                    page_cache = self.page_cache
+                else:
+                    page_cache = None
+                if page_cache is not None:
+                    cached = page_cache.get(url)
+                if cached:
+                    etag = cached.get('etag')
+                    last_modified = cached.get('last_modified')
+                    if etag:
+                        req_headers['If-None-Match'] = etag
+                    if last_modified:
+                        req_headers['If-Modified-Since'] = last_modified
                 try:
                     logger.debug('Fetching %s', url)
-                    resp = self.opener.open(req, timeout=self.timeout)
+                    resp = self._open(url, req_headers)
                     logger.debug('Fetched %s', url)
                     headers = resp.info()
                     content_type = headers.get('Content-Type', '')
                     if HTML_CONTENT_TYPE.match(content_type):
                         final_url = resp.geturl()
-                        data = resp.read()
+                        data = self._read(resp, headers)
                         encoding = headers.get('Content-Encoding')
                         if encoding:
                             decoder = self.decoders[encoding]   # fail if not found
@@ -805,8 +1284,17 @@ class SimpleScrapingLocator(Locator):
                             data = data.decode('latin-1')    # fallback
                         result = Page(data, final_url)
                         self._page_cache[final_url] = result
+                        etag = headers.get('ETag')
+                        last_modified = headers.get('Last-Modified')
+                        if page_cache is not None and (etag or last_modified):
+                            page_cache.put(url, data, final_url, etag,
+                                           last_modified)
                 except HTTPError as e:
-                    if e.code != 404:
+                    if e.code == 304 and cached:
+                        logger.debug('Not modified, using cached %s', url)
+                        result = Page(cached['data'], cached['url'])
+                        self._page_cache[cached['url']] = result
+                    elif e.code != 404:
                         logger.exception('Fetch failed: %s: %s', url, e)
                 except URLError as e:  # pragma: no cover
                     logger.exception('Fetch failed: %s: %s', url, e)
@@ -815,6 +1303,8 @@ class SimpleScrapingLocator(Locator):
                 except Exception as e:  # pragma: no cover
                     logger.exception('Fetch failed: %s: %s', url, e)
                 finally:
+                    if resp is not None:
+                        resp.close()
                     self._page_cache[url] = result   # even if None (failure)
         return result
 
@@ -862,20 +1352,55 @@ class DirectoryLocator(Locator):
         """
         return filename.endswith(self.downloadable_extensions)
 
+    def _iter_urls(self):
+        """
+        Yield file: URLs for the candidate archives under the base directory,
+        in the order os.walk would find them.
+
+        Where os.scandir is available, it's used directly: its entries carry
+        the file type and the joined path, so no further system calls or path
+        manipulation are needed per file. The base directory is absolute, so
+        the paths found under it are too.
+        """
+        if not hasattr(os, 'scandir'):  # pragma: no cover
+            for root, dirs, files in os.walk(self.base_dir):
+                for fn in files:
+                    if self.should_include(fn, root):
+                        fn = os.path.join(root, fn)
+                        yield urlunparse(('file', '', pathname2url(fn),
+                                          '', '', ''))
+                if not self.recursive:
+                    break
+        else:
+            todo = [self.base_dir]
+            while todo:
+                root = todo.pop()
+                try:
+                    entries = list(os.scandir(root))
+                except OSError:  # pragma: no cover
+                    continue    # os.walk ignores these too
+                subdirs = []
+                for entry in entries:
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:  # pragma: no cover
+                        is_dir = False
+                    if is_dir:
+                        # like os.walk, don't follow symlinks to directories
+                        if self.recursive and not entry.is_symlink():
+                            subdirs.append(entry.path)
+                    elif self.should_include(entry.name, root):
+                        yield urlunparse(('file', '', pathname2url(entry.path),
+                                          '', '', ''))
+                # reversed, so that subdirectories are popped in listed order
+                todo.extend(reversed(subdirs))
+
     def _get_project(self, name):
         result = {'urls': {}, 'digests': {}}
-        for root, dirs, files in os.walk(self.base_dir):
-            for fn in files:
-                if self.should_include(fn, root):
-                    fn = os.path.join(root, fn)
-                    url = urlunparse(('file', '',
-                                      pathname2url(os.path.abspath(fn)),
-                                      '', '', ''))
-                    info = self.convert_url_to_download_info(url, name)
-                    if info:
-                        self._update_version_data(result, info)
-            if not self.recursive:
-                break
+        for url in self._iter_urls():
+            info = self.convert_url_to_download_info(url, name)
+            if info:
+                self._update_version_data(result, info)
         return result
 
     def get_distribution_names(self):
@@ -883,18 +1408,10 @@ class DirectoryLocator(Locator):
         Return all the distribution names known to this locator.
         """
         result = set()
-        for root, dirs, files in os.walk(self.base_dir):
-            for fn in files:
-                if self.should_include(fn, root):
-                    fn = os.path.join(root, fn)
-                    url = urlunparse(('file', '',
-                                      pathname2url(os.path.abspath(fn)),
-                                      '', '', ''))
-                    info = self.convert_url_to_download_info(url, None)
-                    if info:
-                        result.add(info['name'])
-            if not self.recursive:
-                break
+        for url in self._iter_urls():
+            info = self.convert_url_to_download_info(url, None)
+            if info:
+                result.add(info['name'])
         return result
 
 class JSONLocator(Locator):
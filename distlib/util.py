@@ -1512,7 +1512,8 @@ class Transport(xmlrpclib.Transport):
         h, eh, x509 = self.get_host_info(host)
         if not self._connection or host != self._connection[0]:
             self._extra_headers = eh
-            self._connection = host, httplib.HTTPConnection(h)
+            self._connection = host, httplib.HTTPConnection(h,
+                                                            timeout=self.timeout)
         return self._connection[1]
 
 if ssl:
@@ -11,7 +11,8 @@ _ver = sys.version_info[:2]
 
 if _ver[0] < 3:
     import Queue as queue
-    from SimpleXMLRPCServer import SimpleXMLRPCServer
+    from SimpleXMLRPCServer import (SimpleXMLRPCServer,
+                                    SimpleXMLRPCRequestHandler)
     from SimpleHTTPServer import SimpleHTTPRequestHandler
     from BaseHTTPServer import HTTPServer
     text_type = unicode
@@ -20,7 +21,7 @@ if _ver[0] < 3:
     from urlparse import urlparse
 else:
     import queue
-    from xmlrpc.server import SimpleXMLRPCServer
+    from xmlrpc.server import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
     from http.server import HTTPServer, SimpleHTTPRequestHandler
     text_type = str
     from urllib.parse import urlparse, unquote
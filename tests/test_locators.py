@@ -5,25 +5,42 @@
 # See LICENSE.txt and CONTRIBUTORS.txt.
 #
 from __future__ import unicode_literals
+import gzip
+import hashlib
+import io
+import json
 import os
 import posixpath
+import shutil
 try:
     import ssl
 except ImportError:
     ssl = None
 import sys
+import tempfile
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
 
-from compat import unittest
+from compat import (unittest, HTTPServer, SimpleHTTPRequestHandler,
+                    SimpleXMLRPCServer, SimpleXMLRPCRequestHandler)
 from support import DistlibTestCase
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
 
-from distlib.compat import url2pathname, urlparse
+from distlib.compat import (url2pathname, pathname2url, urlparse, urljoin,
+                           xmlrpclib)
 from distlib.database import (Distribution, DistributionPath, make_graph,
                               make_dist)
 from distlib.locators import (SimpleScrapingLocator, PyPIRPCLocator,
                               PyPIJSONLocator, DirectoryLocator,
                               DistPathLocator, AggregatingLocator,
                               JSONLocator, DependencyFinder, locate,
-                              get_all_distribution_names, default_locator)
+                              get_all_distribution_names, default_locator,
+                              Page, PageCache, Locator, _link_resolver)
 
 HERE = os.path.abspath(os.path.dirname(__file__))
 
@@ -31,6 +48,144 @@ PYPI_RPC_HOST = 'http://python.org/pypi'
 
 PYPI_WEB_HOST = os.environ.get('PYPI_WEB_HOST', 'https://pypi.org/simple/')
 
+INDEX_PAGES = {
+    '/simple/foo/': '''<html><body>
+<a href="../../packages/foo-1.0.tar.gz#sha256=abcd">foo-1.0.tar.gz</a>
+<a href="../../packages/foo-1.1.zip">foo-1.1.zip</a>
+<a rel="homepage" href="/simple/foo-home/">Home page</a>
+</body></html>''',
+    '/simple/foo-home/': '''<html><body>
+<a href="/packages/foo-2.0.tar.gz">foo-2.0.tar.gz</a>
+</body></html>''',
+}
+
+JSON_PAGES = {
+    '/pypi/foo/json': json.dumps({
+        'info': {'name': 'foo', 'version': '1.1', 'summary': 'A summary'},
+        'urls': [{'url': 'https://example.com/packages/foo-1.1.tar.gz',
+                  'digests': {'sha256': 'abcd'}}],
+        'releases': {
+            '1.0': [{'url': 'https://example.com/packages/foo-1.0.tar.gz',
+                     'digests': {'sha256': 'ef01'}}],
+            '1.1': [{'url': 'https://example.com/packages/foo-1.1.tar.gz',
+                     'digests': {'sha256': 'abcd'}}],
+        },
+    }),
+}
+
+class IndexRequestHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Avoid hanging when a request gets interrupted by the client
+    timeout = 5
+
+    def setup(self):
+        self.server.connections += 1
+        SimpleHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        path = self.path
+        if path in self.server.pages:
+            data = self.server.pages[path].encode('utf-8')
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            if self.headers.get('If-None-Match') == etag:
+                self.server.not_modified += 1
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            if path.endswith('/json'):
+                self.send_header('Content-Type', 'application/json')
+            else:
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                buf = io.BytesIO()
+                f = gzip.GzipFile(fileobj=buf, mode='wb')
+                f.write(data)
+                f.close()
+                data = buf.getvalue()
+                self.send_header('Content-Encoding', 'gzip')
+        elif path in self.server.redirects:
+            data = b''
+            self.send_response(302)
+            self.send_header('Location', self.server.redirects[path])
+        elif path + '/' in self.server.pages:
+            data = b''
+            self.send_response(301)
+            self.send_header('Location', path + '/')
+        else:
+            data = b'Not found'
+            self.send_response(404)
+            self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class IndexServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, redirects=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), IndexRequestHandler)
+        self.pages = pages
+        self.redirects = redirects or {}
+        self.connections = 0
+        self.not_modified = 0
+
+class RPCIndex(object):
+    def package_releases(self, name, show_hidden=False):
+        return ['1.0', '1.1']
+
+    def release_urls(self, name, version):
+        fn = '%s-%s.tar.gz' % (name, version)
+        return [{'url': 'https://example.com/packages/%s' % fn,
+                 'md5_digest': '0123456789abcdef0123456789abcdef'}]
+
+    def release_data(self, name, version):
+        if name == 'bad':
+            raise ValueError('bad release data')
+        return {'name': name, 'version': version, 'summary': 'A summary'}
+
+class RPCRequestHandler(SimpleXMLRPCRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+
+    def setup(self):
+        self.server.connections += 1
+        SimpleXMLRPCRequestHandler.setup(self)
+
+class RPCServer(ThreadingMixIn, SimpleXMLRPCServer):
+    daemon_threads = True
+
+    def __init__(self, multicall):
+        SimpleXMLRPCServer.__init__(self, ('127.0.0.1', 0),
+                                    requestHandler=RPCRequestHandler,
+                                    logRequests=False)
+        self.register_instance(RPCIndex())
+        if multicall:
+            self.register_multicall_functions()
+        self.requests = 0
+        self.connections = 0
+
+    def _marshaled_dispatch(self, *args, **kwargs):
+        self.requests += 1
+        return SimpleXMLRPCServer._marshaled_dispatch(self, *args, **kwargs)
+
+class FixedLocator(Locator):
+    def __init__(self, versions, **kwargs):
+        super(FixedLocator, self).__init__(**kwargs)
+        self.versions = versions
+
+    def _get_project(self, name):
+        result = {'urls': {}, 'digests': {}}
+        for v in self.versions:
+            # legacy accepts any version, so invalid ones can be tested
+            result[v] = make_dist(name, v, scheme='legacy')
+        return result
+
 class LocatorTestCase(DistlibTestCase):
 
     @unittest.skipIf('SKIP_ONLINE' in os.environ, 'Skipping online test')
@@ -61,6 +216,48 @@ class LocatorTestCase(DistlibTestCase):
         finally:
             locator.client('close')()
 
+    def test_xmlrpc_local(self):
+        for multicall in (True, False):
+            server = RPCServer(multicall)
+            t = threading.Thread(target=server.serve_forever, args=(0.05,))
+            t.daemon = True
+            t.start()
+            try:
+                url = 'http://127.0.0.1:%d/RPC2' % server.server_address[1]
+                locator = PyPIRPCLocator(url)
+                result = locator.get_project('foo')
+                self.assertEqual(set(result) - set(['urls', 'digests']),
+                                 set(['1.0', '1.1']))
+                dist = result['1.1']
+                self.assertEqual(dist.name, 'foo')
+                self.assertEqual(dist.source_url,
+                                 'https://example.com/packages/foo-1.1.tar.gz')
+                self.assertEqual(dist.digest,
+                                 ('md5', '0123456789abcdef0123456789abcdef'))
+                self.assertEqual(locator.use_multicall, multicall)
+                if multicall:
+                    # package_releases, then one multicall for the rest
+                    self.assertEqual(server.requests, 2)
+                else:
+                    # package_releases, the failed multicall, then two
+                    # calls per version
+                    self.assertEqual(server.requests, 6)
+                # All the calls share one persistent connection, which
+                # has the locator's timeout applied
+                self.assertEqual(server.connections, 1)
+                conn = locator.client.transport._connection[1]
+                self.assertEqual(conn.timeout, 3.0)
+                locator.client('close')()
+                # A fault from one of the calls is raised, and doesn't stop
+                # multicall from being used (even on the first multicall)
+                locator = PyPIRPCLocator(url)
+                self.assertRaises(xmlrpclib.Fault, locator.get_project, 'bad')
+                self.assertEqual(locator.use_multicall, multicall)
+                locator.client('close')()
+            finally:
+                server.shutdown()
+                server.server_close()
+
     @unittest.skipIf('SKIP_ONLINE' in os.environ, 'Skipping online test')
     @unittest.skipUnless(ssl, 'SSL required for this test.')
     def test_json(self):
@@ -81,6 +278,28 @@ class LocatorTestCase(DistlibTestCase):
         self.assertIn(dist.digests[url], LATEST_SARGE_HASHES)
         self.assertRaises(NotImplementedError, locator.get_distribution_names)
 
+    def test_json_local(self):
+        server = IndexServer(JSON_PAGES)
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.daemon = True
+        t.start()
+        try:
+            url = 'http://127.0.0.1:%d/pypi/' % server.server_port
+            locator = PyPIJSONLocator(url)
+            result = locator.get_project('foo')
+            self.assertFalse(locator.get_errors())
+            self.assertEqual(set(result) - set(['urls', 'digests']),
+                             set(['1.0', '1.1']))
+            dist = result['1.0']
+            self.assertEqual(dist.name, 'foo')
+            self.assertEqual(dist.download_urls,
+                             set(['https://example.com/packages/'
+                                  'foo-1.0.tar.gz']))
+            self.assertEqual(result['1.1'].metadata.summary, 'A summary')
+        finally:
+            server.shutdown()
+            server.server_close()
+
     @unittest.skipIf('SKIP_ONLINE' in os.environ, 'Skipping online test')
     @unittest.skipUnless(ssl, 'SSL required for this test.')
     def test_scraper(self):
@@ -115,6 +334,118 @@ class LocatorTestCase(DistlibTestCase):
         names = locator.get_distribution_names()
         self.assertGreater(len(names), 25000)
 
+    def test_scraper_local(self):
+        fd, secret = tempfile.mkstemp(suffix='.html')
+        with os.fdopen(fd, 'w') as f:
+            f.write('<a href="/packages/foo-9.0.tar.gz">foo-9.0.tar.gz</a>')
+        redirects = {
+            '/simple/secret/': 'file://' + pathname2url(secret),
+        }
+        server = IndexServer(INDEX_PAGES, redirects)
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.daemon = True
+        t.start()
+        try:
+            base = 'http://127.0.0.1:%d/simple/' % server.server_port
+            locator = SimpleScrapingLocator(base, timeout=5.0)
+            result = locator.get_project('foo')
+            versions = set(result) - set(['urls', 'digests'])
+            self.assertEqual(versions, set(['1.0', '1.1', '2.0']))
+            dist = result['1.0']
+            self.assertEqual(dist.digest, ('sha256', 'abcd'))
+            self.assertEqual(dist.source_url,
+                             base.replace('simple/',
+                                          'packages/foo-1.0.tar.gz'))
+            # All of the pages should have been fetched over a single,
+            # persistent connection, which is closed afterwards
+            self.assertEqual(server.connections, 1)
+            self.assertEqual(locator._connections, {})
+            # Redirects are followed, and error pages return None
+            page = locator.get_page(base + 'foo-home')
+            self.assertEqual(page.url, base + 'foo-home/')
+            self.assertIsNone(locator.get_page(base + 'bar/'))
+            # Redirects to local files aren't followed
+            self.assertIsNone(locator.get_page(base + 'secret/'))
+            self.assertEqual(locator._connections, {})
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(secret)
+
+    def test_scraper_full_queue(self):
+        # More links are queued than the queue can hold
+        links = ['<a rel="homepage" href="/home/foo-%d/">Home</a>' % i
+                 for i in range(40)]
+        pages = {'/simple/foo/': '<html><body>%s</body></html>' %
+                                 '\n'.join(links)}
+        for i in range(40):
+            pages['/home/foo-%d/' % i] = ('<a href="/packages/foo-1.%d.tar.gz">'
+                                          'foo-1.%d.tar.gz</a>' % (i, i))
+        server = IndexServer(pages)
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.daemon = True
+        t.start()
+        try:
+            base = 'http://127.0.0.1:%d/simple/' % server.server_port
+            locator = SimpleScrapingLocator(base, timeout=5.0, num_workers=2)
+            self.assertEqual(locator._to_fetch.maxsize, 32)
+            result = locator.get_project('foo')
+            versions = set(result) - set(['urls', 'digests'])
+            self.assertEqual(versions, set(['1.%d' % i for i in range(40)]))
+            self.assertFalse(locator._threads)
+            locator.close_connections()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_page_cache(self):
+        server = IndexServer(INDEX_PAGES)
+        t = threading.Thread(target=server.serve_forever, args=(0.05,))
+        t.daemon = True
+        t.start()
+        cache_dir = tempfile.mkdtemp()
+        try:
+            base = 'http://127.0.0.1:%d/simple/' % server.server_port
+            cache = PageCache(cache_dir)
+            for i in range(2):
+                # Each locator starts with an empty in-memory cache
+                locator = SimpleScrapingLocator(base, timeout=5.0,
+                                                page_cache=cache)
+                page = locator.get_page(base + 'foo-home')
+                self.assertEqual(page.url, base + 'foo-home/')
+                self.assertEqual(page.links,
+                                 [(base.replace('simple/',
+                                                'packages/foo-2.0.tar.gz'),
+                                   '')])
+                self.assertEqual(server.not_modified, i)
+                locator.close_connections()
+            # Local pages aren't cached
+            entries = os.listdir(cache_dir)
+            fn = os.path.join(cache_dir, 'index.html')
+            with open(fn, 'w') as f:
+                f.write('<a href="foo-1.0.tar.gz">foo-1.0.tar.gz</a>')
+            locator = SimpleScrapingLocator(base, page_cache=cache)
+            url = 'file://' + pathname2url(fn)
+            self.assertEqual(locator.get_page(url).url, url)
+            os.remove(fn)
+            self.assertEqual(os.listdir(cache_dir), entries)
+            # Damaged or foreign entries are ignored
+            url = base + 'foo-home'
+            for entry in (b'{"key": "', b'[]', b'{"key": "%s"}' % url.encode()):
+                with open(cache._path(url), 'wb') as f:
+                    f.write(entry)
+                self.assertIsNone(cache.get(url))
+                locator = SimpleScrapingLocator(base, timeout=5.0,
+                                                page_cache=cache)
+                self.assertEqual(locator.get_page(url).url, base + 'foo-home/')
+                locator.close_connections()
+            cache.clear()
+            self.assertIsNone(cache.get(base + 'foo-home'))
+        finally:
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(cache_dir)
+
     @unittest.skipIf('SKIP_ONLINE' in os.environ, 'Skipping online test')
     @unittest.skipUnless(ssl, 'SSL required for this test.')
     def test_unicode_project_name(self):
@@ -383,6 +714,127 @@ class LocatorTestCase(DistlibTestCase):
         for url1, url2 in cases:
             self.assertEqual(default_locator.prefer_url(url1, url2), url1)
 
+    def test_decoders(self):
+        import zlib
+
+        data = b'<a href="foo-1.0.tar.gz">foo</a>' * 100
+        buf = io.BytesIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb')
+        f.write(data)
+        f.close()
+        decoders = SimpleScrapingLocator.decoders
+        self.assertEqual(decoders['gzip'](buf.getvalue()), data)
+        self.assertEqual(decoders['deflate'](zlib.compress(data)), data)
+        self.assertEqual(decoders['none'](data), data)
+
+    def test_page_links(self):
+        data = """<html><head><base href="https://example.com/base/"></head>
+<body><a href="foo-1.0.tar.gz#sha256=abcd">foo-1.0.tar.gz</a>
+<A REL="homepage" HREF='https://example.org/foo/'>Home</A>
+<a href=../bar/?a=1&amp;b=2 rel=download>bar</a>
+<a href="https://example.com/x y">x</a>
+</body></html>"""
+        page = Page(data, 'https://example.com/simple/foo/')
+        self.assertEqual(page.url, 'https://example.com/simple/foo/')
+        self.assertEqual(page.base_url, 'https://example.com/base/')
+        expected = [
+            ('https://example.org/foo/', 'homepage'),
+            ('https://example.com/x%20y', ''),
+            ('https://example.com/base/foo-1.0.tar.gz#sha256=abcd', ''),
+            ('https://example.com/base/', ''),
+            ('https://example.com/bar/?a=1&b=2', 'download'),
+        ]
+        self.assertEqual(page.links, expected)
+
+    def test_link_resolver(self):
+        # Links which are resolved without calling urljoin()
+        resolve = _link_resolver('https://example.com/simple/foo/')
+        cases = (
+            ('a', 'https://example.com/simple/foo/a'),
+            ('./a', 'https://example.com/simple/foo/a'),
+            ('../a/', 'https://example.com/simple/a/'),
+            ('../../a/./b/../c', 'https://example.com/a/c'),
+            ('a?x#f?g', 'https://example.com/simple/foo/a?x#f?g'),
+            ('a?#', 'https://example.com/simple/foo/a'),
+            ('../../packages/ab/foo-1.0.tar.gz#sha256=abcd',
+             'https://example.com/packages/ab/foo-1.0.tar.gz#sha256=abcd'),
+        )
+        for link, expected in cases:
+            self.assertEqual(resolve(link), expected)
+        # Anything else gives whatever urljoin() does (which varies with
+        # the Python version for some of these)
+        bases = ('https://example.com/simple/foo/', 'https://example.com',
+                 'HTTPS://Example.com/a//b/c', 'https://h/a/b?q=1#f',
+                 'https://h/a/./b/', 'file:///tmp/dir/',
+                 'ftp://example.com/a/')
+        links = ('a', './a', '../a', '../../../../a', 'a/./b/../c', '.', '..',
+                 'a/', 'a//b', 'a?x', 'a#f', 'a?#', 'a?x#f?g', 'a/..', 'x/.',
+                 'a b', ' a', '?q', '#f', '/abs', '//h/p', 'http://x/y',
+                 'a;p', 'a:b', '', '../', 'a/b/../../..')
+        for base in bases:
+            resolve = _link_resolver(base)
+            for link in links:
+                self.assertEqual(resolve(link), urljoin(base, link))
+
+    def test_convert_url_to_download_info(self):
+        locator = SimpleScrapingLocator('https://example.com/simple/')
+        base = 'https://example.com/packages/'
+        cases = (
+            ('foo-1.0.tar.gz', 'foo', ('foo', '1.0', 'foo-1.0.tar.gz')),
+            ('foo-1.0.tar.bz2', 'foo', ('foo', '1.0', 'foo-1.0.tar.bz2')),
+            ('foo-1.0.tar', 'foo', ('foo', '1.0', 'foo-1.0.tar')),
+            ('foo-bar-2.0b1.zip', None, ('foo-bar', '2.0b1',
+                                         'foo-bar-2.0b1.zip')),
+            ('foo-2.0-py2.py3-none-any.whl', 'foo',
+             ('foo', '2.0', 'foo-2.0-py2.py3-none-any.whl')),
+            ('foo-1.0.tar.gz', 'bar', None),
+            ('foo-1.0.pdf', 'foo', None),
+            ('foo-1.0.tar.gz.asc', 'foo', None),
+            ('../', 'foo', None),
+            ('foo-1.0.tar.gz?x=1', 'foo', ('foo', '1.0', 'foo-1.0.tar.gz')),
+            ('foo-1.0.tar.gz;x', 'foo', ('foo', '1.0', 'foo-1.0.tar.gz')),
+            ('foo-1.0.tar.gz/', 'foo', ('foo', '1.0', 'foo-1.0.tar.gz')),
+            ('?f=foo-1.0.tar.gz', 'foo', None),
+            ('#foo-1.0.tar.gz', 'foo', None),
+        )
+        for fn, project, expected in cases:
+            info = locator.convert_url_to_download_info(base + fn, project)
+            if expected is None:
+                self.assertIsNone(info)
+            else:
+                actual = (info['name'], info['version'], info['filename'])
+                self.assertEqual(actual, expected)
+                self.assertEqual(info['url'], base + fn)
+        url = base + 'foo-1.0.tar.gz#sha256=abcd'
+        info = locator.convert_url_to_download_info(url, 'foo')
+        self.assertEqual(info['url'], base + 'foo-1.0.tar.gz')
+        self.assertEqual(info['sha256_digest'], 'abcd')
+
+    def test_locate_versions(self):
+        versions = ['0.5.8', '0.6beta3', '0.5.9', '1.0', '0.6', '0.5.9.1']
+        locator = FixedLocator(versions, scheme='legacy')
+        cases = (
+            ('foo', False, '1.0'),
+            ('foo (>0.5.8, <0.6)', False, '0.5.9.1'),
+            ('foo (>0.5.8, <0.6)', True, '0.6beta3'),
+            ('foo (<0.5.8)', False, None),
+            ('foo (>2.0)', True, None),
+        )
+        for reqt, prereleases, expected in cases:
+            dist = locator.locate(reqt, prereleases)
+            if expected is None:
+                self.assertIsNone(dist)
+            else:
+                self.assertEqual(dist.version, expected)
+        # Versions are parsed once, and remembered until the cache is cleared
+        self.assertEqual(len(locator._parsed_versions), len(versions))
+        locator.clear_cache()
+        self.assertEqual(locator._parsed_versions, {})
+        # Invalid versions are skipped
+        locator = FixedLocator(['1.0', 'not-a-version', '1.1.dev1'])
+        self.assertEqual(locator.locate('foo').version, '1.0')
+        self.assertEqual(locator.locate('foo', True).version, '1.1.dev1')
+
     @unittest.skipIf('SKIP_ONLINE' in os.environ, 'Skipping online test')
     @unittest.skipUnless(ssl, 'SSL required for this test.')
     def test_prereleases(self):